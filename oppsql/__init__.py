@@ -1,6 +1,9 @@
+import collections
+import functools
 import warnings
 import re
 
+import numpy as np
 import pandas as pd
 import sqlalchemy as sqa
 
@@ -9,6 +12,18 @@ from . import model as m
 
 __all__ = ['get_unique_param', 'get_vector', 'model']
 
+_CHUNKSIZE = 50000
+
+_SCALAR_TYPES = (int, float, bool, str)
+
+_BOOL_MAP = {'true': True, 'false': False}
+# Same grammar as int() and float(): surrounding whitespace and single underscores between digits are allowed
+_DIGITS = r'\d(?:_?\d)*'
+_INT_RE = re.compile(r'\s*[-+]?{d}\s*'.format(d=_DIGITS))
+_FLOAT_RE = re.compile(r'\s*[-+]?(?:(?:{d}\.?(?:{d})?|\.{d})(?:[eE][-+]?{d})?|(?i:inf|infinity|nan))\s*'
+                       .format(d=_DIGITS))
+_ITERVAR_RE = re.compile(r'\$(\w+)=')
+
 
 def _map_database_value(val):
     """Map values used in the database to the corresponding python data type.
@@ -26,20 +41,13 @@ def _map_database_value(val):
     mapped_val : string or bool
         The given value or its mapped version
     """
-    if val == 'true':
-        return True
-    elif val == 'false':
-        return False
-
-    try:
+    mapped_val = _BOOL_MAP.get(val)
+    if mapped_val is not None:
+        return mapped_val
+    elif _INT_RE.fullmatch(val):
         return int(val)
-    except ValueError:
-        pass
-
-    try:
+    elif _FLOAT_RE.fullmatch(val):
         return float(val)
-    except ValueError:
-        pass
 
     return val
 
@@ -59,19 +67,64 @@ def _map_python_value(val):
     mapped_val : string, int or float
         The given value or its mapped version
     """
-    if type(val) == bool:
-        return str(val).lower()
+    return str(val).lower() if isinstance(val, bool) else val
 
-    return val
+
+def _column_dtype(column):
+    """Get the numpy dtype used to hold the values of a selected column"""
+    if isinstance(column.type, sqa.types.Integer):
+        return np.int64
+    elif isinstance(column.type, sqa.types.Numeric):
+        return np.float64
+    return object
+
+
+def _read_frame(result, columns):
+    """Read a result into a DataFrame, transferring the rows in chunks.
+
+    Each chunk of rows is transferred column-wise into typed numpy arrays, which avoids building the intermediate
+    list of row tuples pandas.read_sql would create.
+
+    Parameters
+    ----------
+    result : sqlalchemy.engine.CursorResult
+        The result to read.
+    columns : sqlalchemy.sql.expression.ColumnCollection
+        The selected columns, as given by the statement's selected_columns. Used to determine the columns' dtypes.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        DataFrame containing one column per selected column.
+    """
+    dtypes = [_column_dtype(column) for column in columns]
+    chunks = [[] for _ in dtypes]
+    for partition in result.partitions(_CHUNKSIZE):
+        for i, dtype in enumerate(dtypes):
+            chunks[i].append(np.fromiter((row[i] for row in partition), dtype=dtype, count=len(partition)))
+
+    # The arrays are handed over to pandas without copying them once more
+    df = pd.DataFrame({key: np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+                       for key, dtype, arrays in zip(result.keys(), dtypes, chunks)}, copy=False)
+
+    # Columns of unknown type, e.g. aggregates, are left for pandas to infer
+    untyped = [key for key, column in zip(result.keys(), columns) if isinstance(column.type, sqa.types.NullType)]
+    if untyped:
+        df[untyped] = df[untyped].infer_objects()
+    return df
 
 
 def _ignore_decimal_warning():
     regex = (
         r"^Dialect sqlite\+pysqlite does \*not\* support Decimal objects natively\, "
-        "and SQLAlchemy must convert from floating point - rounding errors and other "
-        "issues may occur\. Please consider storing Decimal numbers as strings or "
-        "integers on this platform for lossless storage\.$")
-    warnings.filterwarnings('ignore', regex, sqa.exc.SAWarning, r'^sqlalchemy\.sql\.sqltypes$')
+        r"and SQLAlchemy must convert from floating point - rounding errors and other "
+        r"issues may occur\. Please consider storing Decimal numbers as strings or "
+        r"integers on this platform for lossless storage\.$")
+    # SQLAlchemy attributes the warning to the code executing the statement, i.e. this module
+    warnings.filterwarnings('ignore', regex, sqa.exc.SAWarning, r'^oppsql$')
+
+
+_ignore_decimal_warning()
 
 
 def get_iterationvars(engine):
@@ -89,17 +142,25 @@ def get_iterationvars(engine):
     """
     iterationvar_stmt = sqa.select([m.runattr.c.attrValue]).where(m.runattr.c.attrName == 'iterationvars')
 
-    def iterationvar_values_stmt(var):
-        return sqa.select([m.runattr.c.attrValue]).where(m.runattr.c.attrName == var).distinct()
-
     with engine.connect() as conn:
-        iterationvars = ([re.match(r'\$(\w+)=.*', entry).groups(1)[0]
-                          for entry in conn.execute(iterationvar_stmt).fetchone()[0].split(', ')])
-        return {var: [_map_database_value(entry[0]) for entry in conn.execute(iterationvar_values_stmt(var)).fetchall()]
-                for var in iterationvars}
+        iterationvars = _ITERVAR_RE.findall(conn.execute(iterationvar_stmt).scalar())
+        iterationvar_values_stmt = (sqa.select([m.runattr.c.attrName, m.runattr.c.attrValue])
+                                    .where(m.runattr.c.attrName.in_(iterationvars))
+                                    .distinct())
 
+        values = collections.defaultdict(list)
+        for var, value in conn.execute(iterationvar_values_stmt):
+            values[var].append(_map_database_value(value))
+        return {var: values[var] for var in iterationvars}
 
 
+_unique_param_stmt = (sqa.select([m.runparam.c.parValue])
+                      .where(m.runparam.c.parName.like(sqa.bindparam('pattern')))
+                      .distinct())
+
+
+_simtime_exp_stmt = sqa.select([m.run.c.dbId, m.run.c.runId, m.run.c.simtimeExp])
+
 
 def get_unique_param(con, name, type):
     """Get a param which is unique for the database
@@ -109,10 +170,117 @@ def get_unique_param(con, name, type):
     sqlalchemy.MultipleResultsFound
         If the parameter is not unique.
     """
-    return type(con.execute(sqa.select([m.runparam.c.parValue])
-                               .where(m.runparam.c.parName.like('%{}'.format(name)))
-                               .distinct())
-                   .scalar())
+    return type(con.execute(_unique_param_stmt, {'pattern': '%{}'.format(name)}).scalar())
+
+
+def _attribute_values_key(attribute):
+    """Name of the bind parameter holding the values an attribute is filtered for"""
+    return '{}_values'.format(attribute)
+
+
+def _attribute_category_key(attribute, code):
+    """Name of the bind parameter holding the category of an attribute with the given code"""
+    return '{}_category_{}'.format(attribute, code)
+
+
+@functools.lru_cache(maxsize=256)
+def _build_stmt(by_shape, single_variable, time, uniform_timescale, module, aggregated, self_descriptive_result,
+                join_run):
+    """Build the statement underlying get_vector
+
+    Only the shape of the query is fixed by the arguments. The concrete attribute values and variable names are
+    left as bind parameters, so that the statement can be reused by calls that only differ in these values.
+    Aggregation functions and filters have to be applied to the returned statement by the caller.
+
+    Parameters
+    ----------
+    by_shape : tuple of (string, int, bool) tuples
+        The normalized attributes to group results by, paired with the number of values they are filtered for and
+        whether these are categories. Categorical attributes are selected as the codes of their values.
+    single_variable : bool
+        Whether only a single variable is queried.
+    time, module, self_descriptive_result : bool
+        See get_vector.
+    uniform_timescale : bool
+        Whether all runs share the same simtime exponent. The simtime column holds the raw simtimes, which have to
+        be scaled by the caller. Unless the scale is uniform, the run of each row is selected as '_dbId' and
+        '_runId' to allow this.
+    aggregated : bool
+        Whether the results are grouped by the non-singular attributes.
+    join_run : bool
+        Whether the run table is joined, e.g. because the caller's filter refers to it. Otherwise, it is left out.
+
+    Returns
+    -------
+    stmt : sqlalchemy.sql.expression.Select
+        The statement, expecting the bind parameters 'variable', '<attribute>_values' for each filtered
+        attribute and '<attribute>_category_<code>' for each category. The value column is the last one selected.
+    """
+    def single_filter(n_vals):
+        return n_vals == 1
+
+    def attribute_filter_expression(attrs, attribute, n_vals):
+        return sqa.and_(attrs.c.attrName == attribute,
+                        attrs.c.attrValue.in_(sqa.bindparam(_attribute_values_key(attribute), expanding=True))
+                        if n_vals else True)
+
+    def attribute_column(attribute, query):
+        if not categorical[attribute]:
+            return query.c.attrValue.label(attribute)
+        # Values outside the categories, e.g. the NULLs of an empty aggregate, get the code -1 of missing values
+        return sqa.case([(query.c.attrValue == sqa.bindparam(_attribute_category_key(attribute, code)), code)
+                         for code in range(by_shape[attribute])], else_=-1).label(attribute)
+
+    categorical = {attribute: is_categorical for attribute, _, is_categorical in by_shape}
+    by_shape = {attribute: n_vals for attribute, n_vals, _ in by_shape}
+
+    # Attributes pinned to a single value are not part of the result, they only restrict the runs
+    pinned_attributes = [attribute for attribute, n_vals in by_shape.items()
+                         if single_filter(n_vals) and not self_descriptive_result]
+    pinned_constraints = [sqa.exists().where(sqa.and_(m.runattr.c.runId == m.vector.c.runId,
+                                                      m.runattr.c.dbId == m.vector.c.dbId,
+                                                      attribute_filter_expression(m.runattr, attribute,
+                                                                                  by_shape[attribute])))
+                          for attribute in pinned_attributes]
+
+    # The remaining attributes are read from a shared CTE, so that runattr is only scanned once for all of them
+    grouped_attributes = [attribute for attribute in by_shape if attribute not in pinned_attributes]
+    attrs = (sqa.select([m.runattr.c.runId, m.runattr.c.dbId, m.runattr.c.attrName, m.runattr.c.attrValue])
+             .where(m.runattr.c.attrName.in_(grouped_attributes))
+             .cte('attrs'))
+    attribute_subqueries = {attribute: sqa.select([attrs.c.runId, attrs.c.dbId, attrs.c.attrValue])
+                                          .where(attribute_filter_expression(attrs, attribute, by_shape[attribute]))
+                                          .alias()
+                            for attribute in grouped_attributes}
+
+    select = []
+    select.extend(attribute_column(attribute, query) for attribute, query in attribute_subqueries.items())
+    if time:
+        select.append(m.vectordata.c.simtimeRaw.label('simtime'))
+        if not uniform_timescale:
+            select.extend([m.vector.c.dbId.label('_dbId'), m.vector.c.runId.label('_runId')])
+    if module:
+        select.append(m.vector.c.moduleName)
+    if not (single_variable and not self_descriptive_result):
+        select.append(m.vector.c.vectorName)
+    select.append(m.vectordata.c.value)
+
+    tables = m.vector.join(m.vectordata)
+    if join_run:
+        tables = tables.join(m.run)
+    for query in attribute_subqueries.values():
+        tables = tables.join(query, sqa.and_(query.c.runId == m.vector.c.runId, query.c.dbId == m.vector.c.dbId))
+
+    stmt = (sqa.select(select)
+            .select_from(tables)
+            .where(sqa.and_(m.vector.c.vectorName.in_(sqa.bindparam('variable', expanding=True)),
+                            *pinned_constraints)))
+    if aggregated:
+        stmt = stmt.group_by(*(query.c.attrValue
+                               for attribute, query in attribute_subqueries.items()
+                               if not single_filter(by_shape[attribute])))
+
+    return stmt
 
 
 def get_vector(engine, by, variable, time=False, run=False, module=False,
@@ -208,95 +376,80 @@ def get_vector(engine, by, variable, time=False, run=False, module=False,
     3          3  553.535197
     4          4  540.700926
     """
-    _ignore_decimal_warning()
-
     def normalize_by(by):
         """Normalize the different 'by' syntaxes to a map of strings to lists of strings"""
         def normalize_filter(filter_):
-            valid_types = (int, float, bool, str)
             if filter_ is None:
                 return []
-            if type(filter_) in valid_types:
+            if isinstance(filter_, _SCALAR_TYPES):
                 return [filter_]
-            if type(filter_) == list and all(type(val) in valid_types for val in filter_):
+            if isinstance(filter_, list) and all(isinstance(val, _SCALAR_TYPES) for val in filter_):
                 return filter_
             else:
                 raise TypeError("Filter must be string, int, float or bool, a list of these or None")
 
-        if type(by) == str:
+        if isinstance(by, str):
             return {by: []}
-        elif type(by) == list and all(type(attr) == str for attr in by):
-            return {attr: [] for attr in by}
-        elif type(by) == dict and all(type(attr) == str for attr in by):
-            return {attr: normalize_filter(filter_) for attr, filter_ in by.items()}
+        elif isinstance(by, (list, dict)):
+            normalized = {}
+            for attr in by:
+                if not isinstance(attr, str):
+                    raise TypeError("By must be string, list of strings or dictionary")
+                normalized[attr] = normalize_filter(by[attr]) if isinstance(by, dict) else []
+            return normalized
         else:
             raise TypeError("By must be string, list of strings or dictionary")
 
     def normalize_variable(variable):
         """Normalize the different variable syntaxes to a list of strings"""
-        return [variable] if type(variable) == str else variable
+        return [variable] if isinstance(variable, str) else variable
 
-    def simtime(simtime_raw, simtime_exponent):
-        """Compute float simtime from fixed-point notation"""
-        return simtime_raw * 10 ** simtime_exponent
-
-    def single_filter(by, attribute):
-        return len(by[attribute]) == 1
-
-    def attribute_filter_expression(by, attribute):
-        return sqa.and_(m.runattr.c.attrName == attribute,
-                        m.runattr.c.attrValue.in_(_map_python_value(val) for val in by[attribute])
-                        if by[attribute] else True)
+    def categorical(vals):
+        """Whether an attribute filtered for the given values is represented as categories"""
+        return bool(vals) and isinstance(vals[0], str)
 
     # Normalize parameters TODO complete: variables -> list, by -> dict
     by = normalize_by(by)
     variable = normalize_variable(variable)
 
-    attribute_subqueries = {attribute: sqa.select([m.runattr.c.runId, m.runattr.c.dbId, m.runattr.c.attrValue])
-                                          .where(attribute_filter_expression(by, attribute))
-                                          .alias()
-                            for attribute in by}
-
-    select = []
-    select.extend(query.c.attrValue.label(attribute)
-                  for attribute, query in attribute_subqueries.items()
-                  if not (len(by[attribute]) == 1 and not self_descriptive_result))
-    if time:
-        select.append(sqa.func.simtime(m.vectordata.c.simtimeRaw, m.run.c.simtimeExp).label('simtime'))
-    if module:
-        select.append(m.vector.c.moduleName)
-    if not (len(variable) == 1 and not self_descriptive_result):
-        select.append(m.vector.c.vectorName)
-
-    if aggregate is not None:
-        select.append(aggregate(m.vectordata.c.value))
-    else:
-        select.append(m.vectordata.c.value)
-
-    tables = (m.run
-               .join(m.vector)
-               .join(m.vectordata))
-    for query in attribute_subqueries.values():
-        tables = tables.join(query)
+    params = {'variable': variable}
+    params.update((_attribute_values_key(attribute), [_map_python_value(val) for val in vals])
+                  for attribute, vals in by.items() if vals)
+    params.update((_attribute_category_key(attribute, code), _map_python_value(val))
+                  for attribute, vals in by.items() if categorical(vals)
+                  for code, val in enumerate(vals))
 
-    constraints = []
-    if filter_ is not None:
-        constraints.append(filter_)
-    constraints.append((m.vector.c.vectorName.in_(variable)))
-
-    stmt = sqa.select(select).select_from(tables).where(sqa.and_(*constraints))
-    if aggregate is not None:
-        stmt = stmt.group_by(*(query.c.attrValue
-                               for attribute, query in attribute_subqueries.items()
-                               if not single_filter(by, attribute)))
+    join_run = filter_ is not None and m.run in sqa.sql.util.find_tables(filter_, check_columns=True)
 
     with engine.connect() as conn:
+        # The exponent is fixed per run and usually the same for the whole database
         if time:
-            conn.connection.connection.create_function('simtime', 2, simtime)
+            simtime_exps = (_read_frame(conn.execute(_simtime_exp_stmt), _simtime_exp_stmt.selected_columns)
+                            .set_index(['dbId', 'runId'])['simtimeExp'])
+        uniform_timescale = time and simtime_exps.nunique() == 1
+
+        stmt = _build_stmt(tuple((attribute, len(vals), categorical(vals)) for attribute, vals in by.items()),
+                           len(variable) == 1, time, uniform_timescale, module, aggregate is not None,
+                           self_descriptive_result, join_run)
+        if aggregate is not None:
+            stmt = stmt.with_only_columns(list(stmt.selected_columns)[:-1] + [aggregate(m.vectordata.c.value)])
+        if filter_ is not None:
+            stmt = stmt.where(filter_)
 
-        df = pd.read_sql(stmt, conn)
-        for attr, vals in by.items():  # FIXME find out why .assign()-based approach does not work
-            df[attr] = df[attr].astype(pd.api.types.CategoricalDtype(vals, ordered=True)
-                                       if type(vals[0]) == str else type(vals[0]))
+        result = conn.execution_options(stream_results=True).execute(stmt, params)
+        df = _read_frame(result, stmt.selected_columns)
 
-        return df
+    if time:
+        if uniform_timescale:
+            scale = 10.0 ** simtime_exps.iloc[0]
+        else:
+            runs = pd.MultiIndex.from_arrays([df.pop('_dbId'), df.pop('_runId')])
+            scale = np.power(10.0, simtime_exps.reindex(runs).to_numpy())
+        df['simtime'] = df['simtime'].to_numpy() * scale
+
+    # Attributes without filter values have no known type, singular ones are not necessarily part of the result
+    for attr, vals in by.items():
+        if categorical(vals) and attr in df.columns:
+            df[attr] = pd.Categorical.from_codes(df[attr], dtype=pd.api.types.CategoricalDtype(vals, ordered=True))
+    dtypes = {attr: type(vals[0]) for attr, vals in by.items() if vals and not categorical(vals) and attr in df.columns}
+    return df.astype(dtypes)
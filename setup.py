@@ -9,7 +9,8 @@ setup(
     scripts=['scripts/mergeDBs'],
     packages=['oppsql'],
     install_requires=[
-        'sqlalchemy',
+        'sqlalchemy>=1.4,<2',
+        'numpy>=1.23',
         'pandas'
     ]
 )